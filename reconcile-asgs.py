@@ -20,10 +20,26 @@
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import base64
 import yaml
+try:
+    # libyaml-backed loader, if pyyaml was built with it
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 import argparse
 import time
+import functools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+try:
+    # incremental JSON parsing of the listing pages, if available
+    import ijson
+except ImportError:
+    ijson = None
 
 
 # for debugging, export PYTHONWARNINGS="ignore:Unverified HTTPS request"
@@ -32,6 +48,13 @@ if not should_verify:
     import urllib3
     urllib3.disable_warnings()
 
+# concurrent API calls; keep at or below the session pool_maxsize
+max_workers = 16
+# v3 API maximum page size; pagination next links carry it through
+results_per_page = 5000
+# names per filtered lookup, to keep the query string short
+names_per_request = 50
+
 
 class ASGException(Exception):
     def __init__(self, message):
@@ -42,15 +65,56 @@ class ASGException(Exception):
         return 'ASG Exception: {0}'.format(self.message)
 
 
-def get_home():
-    '''get cf-cli configuration information'''
+def cf_config_file():
+    '''path of the cf-cli configuration file'''
     cf_home = os.getenv('CF_HOME')
     if cf_home is None:
         cf_home = os.getenv('HOME')
-    with open(cf_home + "/.cf/config.json") as c:
+    return cf_home + "/.cf/config.json"
+
+
+def get_home():
+    '''get cf-cli configuration information'''
+    with open(cf_config_file()) as c:
         return json.loads(c.read())
 
 
+def save_home(config):
+    '''write back cf-cli configuration information'''
+    # replace atomically, and keep it private - it holds tokens
+    config_file = cf_config_file()
+    fd = os.open(config_file + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                 0o600)
+    with os.fdopen(fd, 'w') as c:
+        c.write(json.dumps(config, indent=2))
+    os.replace(config_file + '.tmp', config_file)
+
+
+def token_expiry(token):
+    '''token_expiry(jwt string) - return "exp" claim, 0 if unreadable'''
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))['exp']
+    except (IndexError, KeyError, TypeError, ValueError):
+        return 0
+
+
+def cf_token(config):
+    '''return the cf-cli access token if it is still valid, otherwise
+refresh it and save the new token in the cf-cli configuration'''
+    token_type, _, access_token = config.get('AccessToken', '').partition(' ')
+    if token_expiry(access_token) - time.time() > 60:
+        return {'token_type': token_type, 'access_token': access_token}
+    auth_refresh = cf_refresh(config)
+    config['AccessToken'] = "%s %s" % (auth_refresh['token_type'],
+                                       auth_refresh['access_token'])
+    if 'refresh_token' in auth_refresh:
+        config['RefreshToken'] = auth_refresh['refresh_token']
+    save_home(config)
+    return auth_refresh
+
+
 def cf_refresh(config):
     '''refresh oauth token'''
     oauth_r = requests.post(config['AuthorizationEndpoint'] + '/oauth/token',
@@ -68,7 +132,10 @@ def cf_refresh(config):
 
 
 # accrued message
-__output_message = {}
+__output_message = defaultdict(lambda: {'groups': []})
+__message_types = frozenset(['deleted',
+                             'unbind_staging', 'bind_staging',
+                             'unbind_running', 'bind_running'])
 
 
 def message(format, type, data):
@@ -78,16 +145,12 @@ def message(format, type, data):
         print("would {}: {}".format(type, json.dumps(data, indent=2)))
         return
     # check message types
-    if type not in ['deleted',
-                    'unbind_staging', 'bind_staging',
-                    'unbind_running', 'bind_running']:
+    if type not in __message_types:
         print("erorr in message type {}: unknown type".format(type),
               file=sys.stderr)
         sys.exit(1)
-    if type in __output_message:
-        __output_message[type]['groups'].append(data.copy())
-    else:
-        __output_message[type] = {'groups': [data.copy()]}
+    # callers pass a fresh dict per message, so no need to copy it
+    __output_message[type]['groups'].append(data)
 
 
 def dump_message(format, run_mode):
@@ -100,190 +163,130 @@ def dump_message(format, run_mode):
     print(json.dumps({'mode': run_msg, 'data': __output_message}, indent=2))
 
 
-def get_running_asgs(base_url, headers):
+def get_running_asgs(base_url, session, debug=False):
     return get_global_sgs(base_url,
-                          '/v2/config/running_security_groups',
-                          headers)
+                          {'globally_enabled_running': 'true'},
+                          session, debug)
 
 
-def get_staging_asgs(base_url, headers):
+def get_staging_asgs(base_url, session, debug=False):
     return get_global_sgs(base_url,
-                          '/v2/config/staging_security_groups',
-                          headers)
+                          {'globally_enabled_staging': 'true'},
+                          session, debug)
 
 
-def get_global_sgs(base_url, runorstage, headers):
-    '''get_sgs(base_url http string, auth dict) - return list of ASGs'''
+def get_global_sgs(base_url, runorstage, session, debug=False):
+    '''get_sgs(base_url http string, runorstage filter dict, session) -
+return list of ASGs'''
     sgs = dict()  # empty list of security groups
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    r = s.get(base_url + runorstage, verify=should_verify)
+    params = {'per_page': results_per_page}
+    params.update(runorstage)
+    r = session.get(base_url + "/v3/security_groups", verify=should_verify,
+                    params=params, stream=True)
     if not r.ok:
         raise ASGException('get_global_sgs fails: {0}'.format(r.url))
-    next_page = True
-    while (next_page):
-        next_page = False
-        sgs_r = r.json()
-        for res in sgs_r['resources']:
-            # get globally bound security groups only
-            entity = res['entity']
-            sgs[entity['name']] = {
-                'name': entity['name'],
-                'running_default': entity['running_default'],
-                'staging_default': entity['staging_default']}
-        if sgs_r['next_url']:
-            r = s.get(sgs_r['next_url'])
-            if not r.ok:
-                raise ASGException('next URL failed {0}'.format(r.url))
-            next_page = True
+    if debug:
+        print("%s: Content-Encoding %s" % (
+            r.url, r.headers.get('Content-Encoding')))
+    for res in iter_resources(session, r):
+        # get globally bound security groups only
+        sgs[res['name']] = {
+            'name': res['name'],
+            'guid': res['guid'],
+            'running_default': res['globally_enabled']['running'],
+            'staging_default': res['globally_enabled']['staging']}
     return sgs
 
 
-def delete_sgs(enforcing, base_url, headers, sgs):
-    '''delete_sgs(base_url http string, auth dict, sgs list of names)
- -- delete list of ASGs'''
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    for del_sg in sgs:
-        # get GUID first
-        sg_r = s.get(base_url + "/v2/security_groups", verify=should_verify,
-                     params={'q': "name:%s" % (del_sg)})
+def get_sg_guids(base_url, names, session, debug=False):
+    '''get_sg_guids(base_url http string, names list, session) - return dict
+of ASG name to guid, for those of the named ASGs that exist'''
+    guid_index = dict()
+    for i in range(0, len(names), names_per_request):
+        r = session.get(base_url + "/v3/security_groups",
+                        verify=should_verify,
+                        params={'names': ','.join(
+                                    names[i:i + names_per_request]),
+                                'per_page': results_per_page},
+                        stream=True)
+        if not r.ok:
+            raise ASGException('get_sg_guids fails: {0}'.format(r.url))
+        if debug:
+            print("%s: Content-Encoding %s" % (
+                r.url, r.headers.get('Content-Encoding')))
+        for res in iter_resources(session, r):
+            guid_index[res['name']] = res['guid']
+    return guid_index
+
+
+def iter_resources(session, r):
+    '''iter_resources(session, first page response) - yield each resource
+of a paginated v3 listing, following the next page links'''
+    while True:
+        next_link = None
+        if ijson is None:
+            sgs_r = r.json()
+            yield from sgs_r['resources']
+            next_link = sgs_r['pagination']['next']
+        else:
+            # parse the page as it arrives, one resource at a time
+            r.raw.decode_content = True
+            builder = None
+            for prefix, event, value in ijson.parse(r.raw):
+                if builder is None and prefix == 'resources.item' and \
+                   event == 'start_map':
+                    builder = ijson.ObjectBuilder()
+                if builder is not None:
+                    builder.event(event, value)
+                    if prefix == 'resources.item' and event == 'end_map':
+                        yield builder.value
+                        builder = None
+                elif prefix == 'pagination.next.href':
+                    next_link = {'href': value}
+            r.close()
+        if not next_link:
+            return
+        r = session.get(next_link['href'], verify=should_verify, stream=True)
+        if not r.ok:
+            raise ASGException('next URL failed {0}'.format(r.url))
+
+
+def delete_sgs(enforcing, base_url, session, guid_index, sgs,
+               json_format=False):
+    '''delete_sgs(base_url http string, session, guid_index dict,
+sgs list of names) -- delete list of ASGs, concurrently'''
+    plan = [(guid_index[del_sg], del_sg) for del_sg in sgs
+            if del_sg in guid_index]
+    for guid, name in plan:
+        message(json_format, 'deleted', {'name': name, 'guid': guid})
+    # v3 deletes are asynchronous jobs, accepted with a 202
+    sg_url = base_url + "/v3/security_groups/"
+    delete = functools.partial(mutate_sg, enforcing, sg_url, session, 'DELETE')
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        list(ex.map(delete,
+                    [guid for guid, _ in plan], [name for _, name in plan]))
+
+
+def mutate_sg(enforcing, sg_url, session, verb, guid, name, data=None):
+    '''mutate_sg(sg_url http string, session, verb string, guid string,
+name string, data dict) -- PATCH/DELETE an ASG, e.g. set global
+running/staging bindings with
+data={'globally_enabled': {'running': True, 'staging': False}}.
+sg_url is the security groups endpoint with a trailing "/", formatted
+once by the caller'''
+    if enforcing:
+        sg_r = session.request(verb, sg_url + guid,
+                               json=data, verify=should_verify)
         if not sg_r.ok:
-            raise ASGException('ASG name {0} lookup failed {1}'.format(
-                del_sg, sg_r.url))
-        sg_detail = sg_r.json()
-        for r in sg_detail['resources']:
-            # assume only one
-            sgs_name = r['entity']['name']
-            sgs_guid = r['metadata']['guid']
-            message(args.json, 'deleted', {'name': sgs_name, 'guid': sgs_guid})
-            if enforcing:
-                dr = s.delete(base_url + "/v2/security_groups/%s" % (sgs_guid),
-                              verify=should_verify)
-                if not dr.ok:
-                    raise ASGException('delete_sgs {0} fails {1}'.format(
-                        del_sg, dr.url))
-
-
-def unbind_staging(enforcing, base_url, headers, ubs_sg):
-    '''unbind_staging(base_url http string, auth dict, ubs_sg names) --
-unbind default staging ASG'''
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    sg_r = s.get(base_url + "/v2/security_groups",
-                 verify=should_verify,
-                 params={'q': "name:%s" % (ubs_sg['name'])})
-    if not sg_r.ok:
-        raise ASGException('unbind_staging: error fetching ASG %s: %s' %
-                           (ubs_sg['name'], sg_r.text))
-    sg_detail = sg_r.json()
-    for r in sg_detail['resources']:
-        # assume only one?
-        sgs_name = r['entity']['name']
-        sgs_guid = r['metadata']['guid']
-        message(args.json,
-                'unbind_staging', {'name': sgs_name, 'guid': sgs_guid})
-        if enforcing:
-            sg_r = s.delete(base_url + '/v2/config/staging_security_groups/%s' % (
-                sgs_guid), verify=should_verify)
-            if not sg_r.ok:
-                raise ASGException('unbind_staging: error unbinding ASG %s: %s' %
-                                   (ubs_sg['name'], sg_r.text))
-
-
-def bind_staging(enforcing, base_url, headers, bs_sg):
-    '''bind_staging(base_url http string, auth dict, bs_sg string sg name)
--- bind default staging ASG'''
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    sg_r = s.get(base_url + "/v2/security_groups",
-                 verify=should_verify,
-                 params={'q': "name:%s" % (bs_sg['name'])})
-    if not sg_r.ok:
-        raise ASGException('unbind_staging: error fetching ASG %s: %s' %
-                           (bs_sg['name'], sg_r.text))
-    sg_detail = sg_r.json()
-    for r in sg_detail['resources']:
-        sgs_name = r['entity']['name']
-        sgs_guid = r['metadata']['guid']
-        message(args.json,
-                'bind_staging', {'name': sgs_name, 'guid': sgs_guid})
-        if enforcing:
-            sg_r = s.put(base_url + '/v2/config/staging_security_groups/%s' % (
-                sgs_guid), verify=should_verify)
-            if not sg_r.ok:
-                raise ASGException('bind_staging: error binding ASG %s: %s' %
-                                   (bs_sg['name'], sg_r.text))
-
-
-def unbind_running(enforcing, base_url, headers, ubr_sg):
-    '''unbind_running(base_url http string, auth dict, ubr_sg name) --
-unbind default running ASG'''
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    sg_r = s.get(base_url + "/v2/security_groups",
-                 verify=should_verify,
-                 params={'q': "name:%s" % (ubr_sg['name'])})
-    if not sg_r.ok:
-        raise ASGException('unbind_running: error fetching ASG %s: %s' %
-                           (ubr_sg['name'], sg_r.text))
-    sg_detail = sg_r.json()
-    for r in sg_detail['resources']:
-        # assume only one?
-        sgs_name = r['entity']['name']
-        sgs_guid = r['metadata']['guid']
-        message(args.json,
-                'unbind_running', {'name': sgs_name, 'guid': sgs_guid})
-        if enforcing:
-            sg_r = s.delete(base_url + "/v2/config/running_security_groups/%s" % (
-                sgs_guid), verify=should_verify)
-            if not sg_r.ok:
-                raise ASGException('unbind_running: error unbinding ASG %s: %s' %
-                                   (ubr_sg['name'], sg_r.text))
-
-
-def bind_running(enforcing, base_url, headers, br_sg):
-    '''bind_running(base_url http string, auth dict, br_sg name) --
-bind default running ASG'''
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    sg_r = s.get(base_url + "/v2/security_groups",
-                 verify=should_verify,
-                 params={'q': "name:%s" % (br_sg['name'])})
-    if not sg_r.ok:
-        raise ASGException('unbind_running: error fetching ASG %s: %s' %
-                           (br_sg['name'], sg_r.text))
-    sg_detail = sg_r.json()
-    for r in sg_detail['resources']:
-        sgs_name = r['entity']['name']
-        sgs_guid = r['metadata']['guid']
-        message(args.json,
-                'bind_running', {'name': sgs_name, 'guid': sgs_guid})
-        if enforcing:
-            sg_r = s.put(base_url + "/v2/config/running_security_groups/%s" % (
-                sgs_guid), verify=should_verify)
-            if not sg_r.ok:
-                raise ASGException('bind_running: error binding ASG %s: %s' %
-                                   (br_sg['name'], sg_r.text))
+            raise ASGException('mutate_sg: %s of ASG %s fails: %s' %
+                               (verb, name, sg_r.text))
 
 
 def add_file(filename):
     '''read a <group>.yml file for allowed security group.
     One security group per file.'''
     with open(filename, 'r') as f:
-        new_sg = yaml.safe_load(f)
+        new_sg = yaml.load(f.read(), Loader=_Loader)
     # validate contents - we need a name
     if 'policy_name' not in new_sg:
         raise ASGException('no policy_name specified in file %s' % (filename))
@@ -318,13 +321,14 @@ parser.add_argument('-j', '--json',
                     help='messages in json format')
 parser.add_argument('file', nargs='*', help='list of files')
 args = parser.parse_args()
+json_format = args.json
 
 # read in ASG configuration file the list of files
 start = time.time()
 configured_list = dict()
-for file in args.file:
-    new = add_file(file)
-    configured_list[new['name']] = new
+with ThreadPoolExecutor(max_workers=max_workers) as ex:
+    for new in ex.map(add_file, args.file):
+        configured_list[new['name']] = new
 end = time.time()
 
 if args.debug:
@@ -335,13 +339,34 @@ if args.debug:
 
 # read in ASGs from the live environment
 start = time.time()
-actual_list = dict()
 config = get_home()
-auth_refresh = cf_refresh(config)
-headers = {'Authorization':
-           auth_refresh['token_type'] + ' ' + auth_refresh['access_token']}
-actual_running_list = get_running_asgs(config['Target'], headers)
-actual_staging_list = get_staging_asgs(config['Target'], headers)
+auth_refresh = cf_token(config)
+# one session (and connection pool) shared by every API call
+session = requests.Session()
+# retry transient API errors with backoff, rather than failing the run;
+# once retries are used up the last response is returned and reported
+retry = Retry(total=3, backoff_factor=0.5,
+              status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods=frozenset(['GET', 'PATCH', 'DELETE']),
+              raise_on_status=False)
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                      max_retries=retry))
+session.headers.update({'Content-Type': 'application/json',
+                        'Accept': 'application/json',
+                        'Authorization': auth_refresh['token_type'] + ' ' +
+                        auth_refresh['access_token']})
+# the running/staging lists are independent, fetch them together
+with ThreadPoolExecutor(max_workers=2) as ex:
+    fut_r = ex.submit(get_running_asgs, config['Target'], session,
+                      args.debug)
+    fut_s = ex.submit(get_staging_asgs, config['Target'], session,
+                      args.debug)
+    actual_running_list, actual_staging_list = fut_r.result(), fut_s.result()
+# the listings carry the guids of every globally bound group
+guid_index = dict()
+for actual_list in (actual_running_list, actual_staging_list):
+    for name, sg in actual_list.items():
+        guid_index[name] = sg['guid']
 end = time.time()
 if args.debug:
     print("actual_asgs (%.02fsec) %d entries: %s\n%s" % (
@@ -353,19 +378,12 @@ if args.debug:
 # compute the "diff" of the *names* of the configured versus actual config'd
 # asgs -- and just delete them
 start = time.time()
-actual_list = dict(actual_running_list, **actual_staging_list)
-delete_asg_names = list(set(actual_list.keys()) -
-                        set(configured_list.keys()))
+actual_names = set(actual_running_list) | set(actual_staging_list)
+delete_asg_names = list(actual_names - configured_list.keys())
 # delete security groups that shouldn't be there, use "args.delete"
 # to determine whether to actually delete
-auth_refresh = cf_refresh(config)
-headers = {'Authorization': "%s %s" % (auth_refresh['token_type'],
-                                       auth_refresh['access_token'])}
-delete_sgs(args.delete, config['Target'], headers, delete_asg_names)
-
-# remove deleted from list of names, so we dont keep scanning them
-for d in delete_asg_names:
-    del actual_list[d]
+delete_sgs(args.delete, config['Target'], session, guid_index,
+           delete_asg_names, json_format=json_format)
 
 end = time.time()
 if args.debug:
@@ -375,27 +393,57 @@ if args.debug:
 # The names should all be legitimate now (for global lists), make sure
 # that the bindings (staging, running, staging+running) is correct
 start = time.time()
-for cfgd_name in configured_list.keys():
+# plan the binding changes first; running and staging changes to the
+# same group are applied together
+plan = list()
+# only membership of the actual lists matters from here on
+running_names = frozenset(actual_running_list)
+staging_names = frozenset(actual_staging_list)
+# groups to be bound that aren't bound anywhere yet need their guids
+# looked up by name
+unbound_names = [name for name, cfg in configured_list.items()
+                 if name not in guid_index and
+                 (cfg['running_default'] is True or
+                  cfg['staging_default'] is True)]
+if unbound_names:
+    guid_index.update(get_sg_guids(config['Target'], unbound_names, session,
+                                   args.debug))
+for cfgd_name, cfg in configured_list.items():
     if args.debug:
         print("checking bindings for", cfgd_name)
-    if configured_list[cfgd_name]['running_default'] is False and \
-       cfgd_name in actual_running_list:
-        unbind_running(args.delete, config['Target'], headers,
-                       configured_list[cfgd_name])
-    if configured_list[cfgd_name]['running_default'] is True and \
-       cfgd_name not in actual_running_list:
-        bind_running(args.delete, config['Target'], headers,
-                     configured_list[cfgd_name])
-    if configured_list[cfgd_name]['staging_default'] is False and \
-       cfgd_name in actual_staging_list:
-        unbind_staging(args.delete, config['Target'], headers,
-                       configured_list[cfgd_name])
-    if configured_list[cfgd_name]['staging_default'] is True and \
-       cfgd_name not in actual_staging_list:
-        bind_staging(args.delete, config['Target'], headers,
-                     configured_list[cfgd_name])
+    if cfgd_name not in guid_index:
+        continue
+    wants_run = cfg['running_default']
+    in_run = cfgd_name in running_names
+    wants_stg = cfg['staging_default']
+    in_stg = cfgd_name in staging_names
+    changes = dict()
+    if wants_run is False and in_run:
+        changes['running'] = False
+    if wants_run is True and not in_run:
+        changes['running'] = True
+    if wants_stg is False and in_stg:
+        changes['staging'] = False
+    if wants_stg is True and not in_stg:
+        changes['staging'] = True
+    if changes:
+        plan.append((guid_index[cfgd_name], cfgd_name, changes))
+for guid, name, changes in plan:
+    for kind, enabled in changes.items():
+        message(json_format,
+                '%s_%s' % ('bind' if enabled else 'unbind', kind),
+                {'name': name, 'guid': guid})
+# the planned changes are independent of each other, so run them
+# concurrently over the shared session
+sg_url = config['Target'] + "/v3/security_groups/"
+patch = functools.partial(mutate_sg, args.delete, sg_url, session, 'PATCH')
+with ThreadPoolExecutor(max_workers=max_workers) as ex:
+    list(ex.map(patch,
+                [guid for guid, _, _ in plan],
+                [name for _, name, _ in plan],
+                [{'globally_enabled': changes} for _, _, changes in plan]))
 end = time.time()
 if args.debug:
-    print("reconcile ASG bindings (%.02fsec) %d entries" % (
-        (end - start), len(configured_list)))
-dump_message(args.json, args.delete)
+    print("reconcile ASG bindings (%.02fsec) %d entries, %d changed" % (
+        (end - start), len(configured_list), len(plan)))
+dump_message(json_format, args.delete)
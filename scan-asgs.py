@@ -20,62 +20,78 @@
 import os
 import sys
 import requests
+from requests.adapters import HTTPAdapter
 import json
+try:
+    # faster JSON parsing for large listings, if available
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 import argparse
 import time
 import ipaddress
 import re
+import bisect
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 should_verify = False
 if not should_verify:
     import urllib3
     urllib3.disable_warnings()
 
+# v2 API maximum page size; the default is 50
+results_per_page = 100
+
 
 def get_home():
     '''get cf-cli configuration information'''
     cf_home = os.getenv('CF_HOME')
     if cf_home is None:
         cf_home = os.getenv('HOME')
-    with open(cf_home + "/.cf/config.json") as c:
-        return json.loads(c.read())
-
-
-def cf_refresh(config):
-    '''refresh oauth token'''
-    oauth_r = requests.post(config['AuthorizationEndpoint'] + '/oauth/token',
-                            data={
-                                'refresh_token': config['RefreshToken'],
-                                'grant_type': 'refresh_token',
-                                'client_id': 'cf'},
-                            auth=('cf', ''),
-                            verify=should_verify)
+    with open(cf_home + "/.cf/config.json", 'rb') as c:
+        return json_loads(c.read())
+
+
+def cf_refresh(config, session):
+    '''cf_refresh(config dict, requests session) - refresh oauth token'''
+    oauth_r = session.post(config['AuthorizationEndpoint'] + '/oauth/token',
+                           data={
+                               'refresh_token': config['RefreshToken'],
+                               'grant_type': 'refresh_token',
+                               'client_id': 'cf'},
+                           auth=('cf', ''),
+                           verify=should_verify)
     if not oauth_r.ok:
-        print("error in token refresh:", oauth_r.json()['error_description'],
+        print("error in token refresh:",
+              json_loads(oauth_r.content)['error_description'],
               file=sys.stderr)
         sys.exit(1)
-    return oauth_r.json()
+    return json_loads(oauth_r.content)
 
 
 def compile_networks(nets):
     '''compile_networks(list networks as strings) - list of ipaddress'''
-    if type(nets) is not list:
+    if not isinstance(nets, (list, tuple)):
         raise ValueError('expected list of strings')
-    ip_n = list()
-    for n in nets:
-        if n.find('-') > 0:  # ugly range specifier
-            n_start, n_end = n.split('-')
-            # next - summarize the start/end addresses, but ipaddress
-            # returns an iterator, to use list comprehension to make
-            # it a list
-            ip_n.extend([x for x in ipaddress.summarize_address_range(
-                ipaddress.ip_address(n_start),
-                ipaddress.ip_address(n_end))])
-        else:
-            # simpler network constructs - ip addresses and cidr formats
-            ip_n.append(ipaddress.ip_network(n))
-    ip_n = list(ipaddress.collapse_addresses(ip_n))
-    return ip_n
+    return list(ipaddress.collapse_addresses(
+        ip_n for n in nets for ip_n in compile_network(n)))
+
+
+@functools.lru_cache(maxsize=8192)
+def compile_network(n):
+    '''compile_network(network as string) - tuple of ipaddress; cached, as
+the same destinations recur across many ASGs.  Not collapsed - callers
+collapse once over everything they gather'''
+    if '-' in n:  # ugly range specifier
+        n_start, _, n_end = n.partition('-')
+        # summarize the start/end addresses; already the minimal set of
+        # networks covering the range
+        return tuple(ipaddress.summarize_address_range(
+            ipaddress.ip_address(n_start),
+            ipaddress.ip_address(n_end)))
+    # simpler network constructs - ip addresses and cidr formats
+    return (ipaddress.ip_network(n),)
 
 
 def sg_network_in_policy(sg, args):
@@ -83,126 +99,157 @@ def sg_network_in_policy(sg, args):
     # check for exceptions to policy
     if args.skip is not None and sg['name'] in args.skip:
         return True
-    if args.skip_re is not None:
-        for r in args.skip_rec:
-            if r.match(sg['name']):
-                return True
+    if args.skip_re is not None and \
+       any(p.match(sg['name']) for p in args.skip_rec):
+        return True
     # collect all addresses, and apply policy to them in aggregate
     ip_n_list = list()
     for sg_rule in sg['rules']:
         if 'destination' not in sg_rule:
             return False
-        ip_n_list.extend(compile_networks([sg_rule['destination']]))
+        parts = compile_network(sg_rule['destination'])
+        # a rule that is too wide on its own fails however it aggregates,
+        # so don't bother collapsing the rest
+        for ip_n in parts:
+            if ip_n.prefixlen < args.min_cidr:
+                if args.debug:
+                    print("%s rule %s fails /%d check" %
+                          (sg['name'], ip_n, args.min_cidr))
+                return False
+        ip_n_list.extend(parts)
     # take aggregate of addresses, and apply policy - this avoids
     # splitting non-compliant policy across serveral rules to
     # circumvent controls (note that this does not prevent it from
     # being done across multiple policies)
     ip_n_list = list(ipaddress.collapse_addresses(ip_n_list))
+    # networks of another IP version never overlap the banned networks
+    check_banned = args.network is not None and ip_n_list and \
+        ip_n_list[0].version == args.banned_version
     for ip_n in ip_n_list:
         if ip_n.prefixlen < args.min_cidr:
             if args.debug:
                 print("%s rule %s fails /%d check" %
                       (sg['name'], ip_n, args.min_cidr))
             return False
-        # no referring to banned networks
-        if args.network is not None:
-            for banned in args.banned_networks:
-                if ip_n.overlaps(banned):
-                    if args.debug:
-                        print("%s rule %s fails banned nets" %
-                              (sg['name'], ip_n))
-                    return False
+        # no referring to banned networks; the banned intervals are
+        # sorted and disjoint, so only the last one starting at or before
+        # the end of this network can overlap it
+        if check_banned:
+            i = bisect.bisect_right(args.banned_starts,
+                                    int(ip_n.broadcast_address))
+            if i > 0 and \
+               args.banned_ends[i - 1] >= int(ip_n.network_address):
+                if args.debug:
+                    print("%s rule %s fails banned nets" %
+                          (sg['name'], ip_n))
+                return False
     return True  # network policy passed
 
 
-def get_sgs(base_url, headers, args):
-    '''get_sgs(base_url http string, auth dict) - return list of ASGs'''
+def get_sgs(base_url, session, args):
+    '''get_sgs(base_url http string, requests session) - return list of ASGs'''
     sgs = list()  # empty list of security groups
-    s = requests.Session()
-    s.headers.update({'Content-Type': 'application/json',
-                      'Accept': 'application/json'})
-    s.headers.update(headers)
-    r = s.get(base_url + "/v2/security_groups", verify=should_verify)
-    next_page = True
-    while next_page:
-        next_page = False
-        sgs_r = r.json()
-        for res in sgs_r['resources']:
-            sgs.append(res['entity'])
-        # get next page, if it's not empty
-        if sgs_r['next_url']:
-            r = s.get(sgs_r['next_url'])
-            next_page = True
+    r = session.get(base_url + "/v2/security_groups",
+                    params={'results-per-page': results_per_page},
+                    verify=should_verify)
+    sgs_r = json_loads(r.content)
+    for res in sgs_r['resources']:
+        sgs.append(res['entity'])
+
+    def get_page(page):
+        return json_loads(session.get(base_url + "/v2/security_groups",
+                                      params={'page': page,
+                                              'results-per-page':
+                                              results_per_page},
+                                      verify=should_verify).content)
+    # the first page gives the page count; fetch the rest concurrently
+    # over the same session (shared connection pool)
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        for page_r in ex.map(get_page, range(2, sgs_r['total_pages'] + 1)):
+            for res in page_r['resources']:
+                sgs.append(res['entity'])
     return sgs
 
 
-# main
-parser = argparse.ArgumentParser(prog='scan-asgs',
-                                 description='scan ASGs for policy violations',
-                                 fromfile_prefix_chars='@',
-                                 epilog='variables can be set in a file, and referenced with @filename - e.g. \"scan-asgs @longlistofargs.txt\"')
-parser.add_argument('-D', '--debug',
-                    action='store_true',
-                    default=False,
-                    help='enable debug messages')
-parser.add_argument('-r', '--skip-re',
-                    action='append',
-                    help='regular expression for policy names to skip')
-parser.add_argument('-s', '--skip',
-                    action='append',
-                    help='ASG names to skip policy enforcement')
-parser.add_argument('-n', '--network',
-                    action='append',
-                    help='networks to ban from ASGs')
-parser.add_argument('-m', '--min-cidr',
-                    action='store',
-                    type=int,
-                    default=22,
-                    help='minimum cidr length allowable (default 22)')
-args = parser.parse_args()
-
-# set up configuration for API
-config = get_home()
-auth_refresh = cf_refresh(config)
-headers = {
-    'Authorization': auth_refresh['token_type'] +
-    ' ' + auth_refresh['access_token']}
-
-# convert/compress networks into ipaddress format; note that we parse
-# ranges as well, otherwise we could just use argparse
-# type=ipaddress.ip_network
-if args.network is not None:
-    banned_networks = compile_networks(args.network)
-    args.banned_networks = banned_networks
-    if args.debug:
-        print("Networks:", banned_networks)
+# main - guarded, as the policy checks run in worker processes
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='scan-asgs',
+                                     description='scan ASGs for policy violations',
+                                     fromfile_prefix_chars='@',
+                                     epilog='variables can be set in a file, and referenced with @filename - e.g. \"scan-asgs @longlistofargs.txt\"')
+    parser.add_argument('-D', '--debug',
+                        action='store_true',
+                        default=False,
+                        help='enable debug messages')
+    parser.add_argument('-r', '--skip-re',
+                        action='append',
+                        help='regular expression for policy names to skip')
+    parser.add_argument('-s', '--skip',
+                        action='append',
+                        help='ASG names to skip policy enforcement')
+    parser.add_argument('-n', '--network',
+                        action='append',
+                        help='networks to ban from ASGs')
+    parser.add_argument('-m', '--min-cidr',
+                        action='store',
+                        type=int,
+                        default=22,
+                        help='minimum cidr length allowable (default 22)')
+    args = parser.parse_args()
+
+    # set up configuration for API
+    config = get_home()
+    # one session (and connection pool) for the token refresh and the
+    # concurrent page fetches
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=32,
+                                          pool_maxsize=32))
+    auth_refresh = cf_refresh(config, session)
+    session.headers.update({'Content-Type': 'application/json',
+                            'Accept': 'application/json',
+                            'Authorization': auth_refresh['token_type'] +
+                            ' ' + auth_refresh['access_token']})
+
+    # convert/compress networks into ipaddress format; note that we parse
+    # ranges as well, otherwise we could just use argparse
+    # type=ipaddress.ip_network
+    if args.network is not None:
+        banned_networks = compile_networks(args.network)
+        # and as sorted integer (start, end) intervals for the policy check
+        args.banned_version = banned_networks[0].version
+        args.banned_starts = [int(n.network_address) for n in banned_networks]
+        args.banned_ends = [int(n.broadcast_address) for n in banned_networks]
+        if args.debug:
+            print("Networks:", banned_networks)
+
+    if args.skip is not None:
+        args.skip = frozenset(args.skip)
+        if args.debug:
+            print("Skip groups:", args.skip)
+    if args.skip_re is not None:
+        # compiled once, rather than for every ASG checked; each pattern
+        # on its own, as inline flags and backreferences are per pattern
+        args.skip_rec = [re.compile(r) for r in args.skip_re]
+        if args.debug:
+            print("Skip regexs:", args.skip_re)
+
+    # get all application security groups
+    asg_get_start = time.perf_counter()
+    all_asgs = get_sgs(config['Target'], session, args)
+    asg_get_end = time.perf_counter()
+
+    # get a list of failing asgs
+    fail_check_start = time.perf_counter()
+    # the checks are CPU bound and independent per ASG, spread them over
+    # worker processes
+    with ProcessPoolExecutor() as ex:
+        results = ex.map(functools.partial(sg_network_in_policy, args=args),
+                         all_asgs, chunksize=64)
+        failing_asgs = [sg for sg, ok in zip(all_asgs, results) if not ok]
+    fail_check_end = time.perf_counter()
 
-if args.skip is not None:
-    if args.debug:
-        print("Skip groups:", args.skip)
-if args.skip_re is not None:
-    args.skip_rec = list()
-    for r in args.skip_re:
-        p = re.compile(r)
-        args.skip_rec.append(p)
     if args.debug:
-        print("Skip regexs:", args.skip_re)
-
-# get all application security groups
-asg_get_start = time.time()
-all_asgs = get_sgs(config['Target'], headers, args)
-asg_get_end = time.time()
-
-# get a list of failing asgs
-fail_check_start = time.time()
-failing_asgs = list()
-fail_check_end = time.time()
-for sg in all_asgs:
-    if not sg_network_in_policy(sg, args):
-        failing_asgs.append(sg)
-
-if args.debug:
-    print("get_sgs (%.02fsec): failing (%.02fsec): %s" % (
-        (asg_get_end - asg_get_start),
-        (fail_check_end - fail_check_start),
-        [group['name'] for group in failing_asgs]))
+        print("get_sgs (%.02fsec): failing (%.02fsec): %s" % (
+            (asg_get_end - asg_get_start),
+            (fail_check_end - fail_check_start),
+            [group['name'] for group in failing_asgs]))